@@ -1,9 +1,18 @@
 import streamlit as st
 import pandas as pd
-from supabase import create_client, Client
+import numpy as np
+from supabase import create_client, Client, ClientOptions
+from postgrest.exceptions import APIError
 import plotly.express as px
 import plotly.graph_objects as go
 import os
+import time
+import random
+import hashlib
+from pathlib import Path
+import asyncio
+import httpx
+import asyncpg
 import bcrypt
 import extra_streamlit_components as stx
 
@@ -18,7 +27,7 @@ st.set_page_config(page_title="CloudAI 2026 Summary", layout="wide")
 
 # ── Supabase connection ──────────────────────────────────────────────────────
 
-def init_supabase():
+def get_supabase_credentials():
     url = os.getenv("SUPABASE_URL")
     key = os.getenv("SUPABASE_KEY")
     if not url or not key:
@@ -30,9 +39,59 @@ def init_supabase():
     if not url or not key:
         st.error("Please set SUPABASE_URL and SUPABASE_KEY in .env file or Streamlit secrets")
         st.stop()
-    return create_client(url, key)
+    return url, key
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# PostgREST's own transient errors (503/504: db unreachable, schema cache, pool timeout);
+# APIError carries these codes rather than the HTTP status
+RETRY_PGRST_CODES = {'PGRST000', 'PGRST001', 'PGRST002', 'PGRST003'}
+
+def _backoff_delay(attempt, base=0.5, cap=16):
+    """Exponential backoff with jitter, in seconds."""
+    return min(cap, base * 2 ** attempt) + random.uniform(0, 0.5)
+
+def _with_backoff(fn, max_retries=5, base=0.5, cap=16):
+    """Call fn(), retrying throttled (429) and transient 5xx Supabase errors."""
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except (APIError, httpx.HTTPStatusError) as e:
+            if isinstance(e, httpx.HTTPStatusError):
+                retryable = e.response.status_code in RETRY_STATUSES
+            else:
+                code = str(e.code)
+                retryable = code in RETRY_PGRST_CODES or (code.isdigit() and int(code) in RETRY_STATUSES)
+            if not retryable or attempt == max_retries:
+                raise
+            time.sleep(_backoff_delay(attempt, base, cap))
+
+def get_db_url():
+    """Optional direct Postgres DSN (Supabase pooler connection string)."""
+    url = os.getenv("SUPABASE_DB_URL")
+    if not url:
+        try:
+            url = st.secrets["SUPABASE_DB_URL"]
+        except:
+            pass
+    return url
 
-supabase = init_supabase()
+@st.cache_resource
+def init_supabase():
+    """Shared client for all sessions; its httpx client keeps connections alive."""
+    url, key = get_supabase_credentials()
+    http_client = httpx.Client(
+        transport=httpx.HTTPTransport(
+            retries=3,
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+        ),
+        timeout=30,
+        follow_redirects=True,
+        verify=True,
+    )
+    return create_client(url, key, options=ClientOptions(httpx_client=http_client))
+
+get_supabase_credentials()  # fail fast with a clear message; the client itself is created lazily
 
 # ── Cookie manager (for "stay signed in") ────────────────────────────────────
 
@@ -59,7 +118,9 @@ def authenticate(username: str, password: str):
     Table columns: username, password_hash, cooperative_name, role (optional)
     """
     try:
-        result = supabase.table('users').select('*').eq('username', username.strip()).execute()
+        result = _with_backoff(
+            init_supabase().table('users').select('*').eq('username', username.strip()).execute
+        )
     except Exception as e:
         st.error(f"Could not query users table: {e}")
         return False, None
@@ -79,9 +140,9 @@ def update_password(username: str, new_password: str):
     """Store new bcrypt-hashed password in users table."""
     try:
         new_hash = hash_password(new_password).decode()
-        supabase.table('users').update(
+        _with_backoff(init_supabase().table('users').update(
             {'password_hash': new_hash}
-        ).eq('username', username).execute()
+        ).eq('username', username).execute)
         return True
     except Exception as e:
         st.error(f"Failed to update password: {e}")
@@ -123,11 +184,13 @@ if not st.session_state['authenticated']:
     saved_username = cookie_manager.get('cloudia_user')
     if saved_username:
         try:
-            result = supabase.table('users').select('*').eq('username', saved_username).execute()
+            result = _with_backoff(
+                init_supabase().table('users').select('*').eq('username', saved_username).execute
+            )
             if result.data:
                 st.session_state['authenticated'] = True
                 st.session_state['user'] = result.data[0]
-        except:
+        except Exception:
             pass
 
 if not st.session_state['authenticated']:
@@ -174,198 +237,472 @@ with st.sidebar:
 
 # ── Load data ────────────────────────────────────────────────────────────────
 
-@st.cache_data(ttl=300)
-def load_data():
-    def load_batched(table_name, page_size=1000):
-        offset = 0
-        all_rows = []
+SUMMARY_RPC = 'get_farmer_delivery_summary'  # see sql/get_farmer_delivery_summary.sql
+TRACE_VIEW = 'v_traceability'  # see sql/v_traceability.sql
+TRACE_AGG_VIEW = 'v_trace_agg'  # see sql/v_trace_agg.sql
+PAGE_SIZE = 10000  # requires PostgREST max-rows >= 10000; smaller server limits are detected
+CACHE_DIR = Path('.cache')
+DATA_TTL = 300  # max age of loaded data in seconds, across the disk and in-memory tiers
+POSTGRES_CONNECT_TIMEOUT = 5  # seconds
+SUMMARY_COLUMNS = ['farmer_id', 'cooperative', 'max_quota_kg', 'net_weight_kg', 'certification', 'exporter']
+TRACE_COLUMNS = ['farmer_id', 'net_weight_kg', 'certification', 'exporter']
+
+async def fetch_all_pages(path, filters=None, select='*', page_size=PAGE_SIZE):
+    """
+    Fetch every row of a PostgREST table/RPC. The first page also asks for the
+    exact row count, the remaining pages are then requested concurrently.
+    filters maps column -> value and is applied server-side as eq.<value>.
+    """
+    params = {'select': select}
+    for col, value in (filters or {}).items():
+        params[col] = f'eq.{value}'
+    url, key = get_supabase_credentials()
+    headers = {'apikey': key, 'Authorization': f'Bearer {key}', 'Accept-Encoding': 'gzip'}
+    limits = httpx.Limits(max_keepalive_connections=16, max_connections=32)
+
+    in_flight = asyncio.Semaphore(16)
+    throttled = False  # set when the API reports <10% of its rate limit left
+
+    async with httpx.AsyncClient(base_url=f"{url}/rest/v1", headers=headers,
+                                 http2=True, limits=limits, timeout=30) as client:
+        async def fetch_page(offset, count=False, max_retries=5):
+            nonlocal throttled
+            page_headers = {'Range-Unit': 'items', 'Range': f'{offset}-{offset + page_size - 1}'}
+            if count:
+                page_headers['Prefer'] = 'count=exact'
+            for attempt in range(max_retries + 1):
+                async with in_flight:
+                    if throttled:
+                        await asyncio.sleep(_backoff_delay(0))
+                    response = await client.get(path, params=params, headers=page_headers)
+                if response.status_code in RETRY_STATUSES and attempt < max_retries:
+                    await asyncio.sleep(_backoff_delay(attempt))
+                    continue
+                response.raise_for_status()
+                remaining = response.headers.get('X-RateLimit-Remaining')
+                limit = response.headers.get('X-RateLimit-Limit')
+                if remaining and limit:
+                    throttled = int(remaining) < 0.1 * int(limit)
+                return response
+
+        first = await fetch_page(0, count=True)
+        rows = first.json()
+        total = int(first.headers['Content-Range'].split('/')[-1])  # e.g. "0-999/4321"
+        if rows and len(rows) < min(page_size, total):
+            page_size = len(rows)  # server max-rows is lower than requested
+        pages = await asyncio.gather(*[fetch_page(offset) for offset in range(page_size, total, page_size)])
+        for page in pages:
+            rows.extend(page.json())
+    return rows
+
+def load_batched(source, filters=None, optional=False):
+    """Load a table/view/RPC path; optional sources return None when not deployed (404)."""
+    try:
+        rows = asyncio.run(fetch_all_pages(source, filters))
+        return pd.DataFrame(rows)
+    except httpx.HTTPStatusError as e:
+        if optional and e.response.status_code == 404:
+            return None
+        st.error(f"Error loading '{source}': {e}")
+        return pd.DataFrame()
+    except Exception as e:
+        st.error(f"Error loading '{source}': {e}")
+        return pd.DataFrame()
+
+async def fetch_from_postgres(dsn, coop=None):
+    """
+    Bulk load over a direct asyncpg connection, skipping PostgREST's per-request
+    overhead and JSON encoding. Same sources and coop filter as the REST path.
+    """
+    # statement_cache_size=0: the Supabase pooler in transaction mode can't keep prepared statements
+    # timeout: a wrong or unreachable DSN should fall back to REST quickly, not after 60 s
+    conn = await asyncpg.connect(dsn, ssl='require', statement_cache_size=0, timeout=POSTGRES_CONNECT_TIMEOUT)
+    try:
+        if coop is not None:
+            summary = await conn.fetch(f'SELECT * FROM {SUMMARY_RPC}() WHERE cooperative = $1', coop)
+            trace = await conn.fetch(f'SELECT * FROM {TRACE_VIEW} WHERE cooperative = $1', coop)
+        else:
+            summary = await conn.fetch(f'SELECT * FROM {SUMMARY_RPC}()')
+            trace = await conn.fetch('SELECT * FROM traceability')
+    finally:
+        await conn.close()
+
+    def to_df(records):
+        return pd.DataFrame(records, columns=list(records[0].keys())) if records else pd.DataFrame()
+    return to_df(summary), to_df(trace)
+
+def fetch_data(coop=None):
+    """Fetch the farmer summary and traceability rows, restricted to coop when given."""
+    dsn = get_db_url()
+    if dsn:
         try:
-            while True:
-                result = supabase.table(table_name).select('*').range(offset, offset + page_size - 1).execute()
-                rows = result.data
-                if rows is None:
-                    st.error(f"Failed to fetch data from '{table_name}' — no data returned.")
-                    return pd.DataFrame()
-                if not rows:
-                    break
-                all_rows.extend(rows)
-                offset += page_size
-            return pd.DataFrame(all_rows)
+            st.info("Loading data from Postgres...")
+            merged_df, trace_df = asyncio.run(fetch_from_postgres(dsn, coop))
+            st.success(f"✓ Loaded {len(merged_df)} farmers and {len(trace_df)} traceability records")
+            return merged_df, trace_df
         except Exception as e:
-            st.error(f"Error loading '{table_name}': {e}")
-            return pd.DataFrame()
+            st.warning(f"Direct Postgres load failed ({e}) — falling back to the REST API.")
 
-    st.info("Loading farmers data...")
-    farmers_df = load_batched('farmers')
+    filters = {'cooperative': coop} if coop is not None else None
+
+    st.info("Loading farmer delivery summary...")
+    merged_df = load_batched(f'rpc/{SUMMARY_RPC}', filters, optional=True)
     st.info("Loading traceability data...")
-    trace_df = load_batched('traceability')
-    st.success(f"✓ Loaded {len(farmers_df)} farmers and {len(trace_df)} traceability records")
-    return farmers_df, trace_df
+    trace_df = load_batched(TRACE_VIEW, filters, optional=True) if coop is not None else None
+    if trace_df is None:
+        # Unfiltered rows are still correct: filter_traceability keeps only the selected farmers
+        trace_df = load_batched('traceability')
+    if merged_df is None:
+        # Per-farmer aggregation still happens in Postgres; only the join is done here
+        trace_agg = load_batched(TRACE_AGG_VIEW, optional=True)
+        if trace_agg is None:
+            st.error(f"Neither function '{SUMMARY_RPC}' nor view '{TRACE_AGG_VIEW}' exists. "
+                     "Apply sql/v_trace_agg.sql (and sql/get_farmer_delivery_summary.sql) in Supabase.")
+            merged_df = pd.DataFrame(columns=SUMMARY_COLUMNS)
+        else:
+            st.warning(f"Function '{SUMMARY_RPC}' not found — joining farmers with '{TRACE_AGG_VIEW}' in the app.")
+            farmers_df = load_batched('farmers', filters)
+            if farmers_df.empty:
+                farmers_df = farmers_df.reindex(columns=['farmer_id', 'cooperative', 'max_quota_kg'])
+            if trace_agg.empty:
+                trace_agg = trace_agg.reindex(columns=TRACE_COLUMNS)
+            farmers_df['farmer_id'] = farmers_df['farmer_id'].astype(str).str.strip().str.lower()
+            merged_df = farmers_df.merge(trace_agg, on='farmer_id', how='left')
+    st.success(f"✓ Loaded {len(merged_df)} farmers and {len(trace_df)} traceability records")
+    return merged_df, trace_df
+
+def _load_with_disk_cache(fetch, key=None, ttl=DATA_TTL // 2):
+    """
+    Second cache tier below st.cache_data: parquet files in .cache/ survive
+    process restarts, so a freshly booted worker skips Supabase while they
+    are younger than ttl seconds. key separates filtered loads on disk.
+    A frame read here can then live in load_data's cache for its own TTL, so
+    data is at most ttl + load_data's TTL old; both are DATA_TTL // 2.
+    """
+    suffix = '' if key is None else '-' + hashlib.sha1(key.encode()).hexdigest()[:12]
+    farmers_path = CACHE_DIR / f'farmers{suffix}.parquet'
+    trace_path = CACHE_DIR / f'trace{suffix}.parquet'
 
-try:
-    farmers_df, trace_df = load_data()
-
-    # Standardize farmer_id
-    farmers_df['farmer_id'] = farmers_df['farmer_id'].astype(str).str.strip().str.lower()
-    trace_df['farmer_id'] = trace_df['farmer_id'].astype(str).str.strip().str.lower()
-
-    # Aggregate traceability per farmer
-    trace_agg = trace_df.groupby('farmer_id').agg({
-        'net_weight_kg': 'sum',
-        'certification': lambda x: ', '.join([str(v) for v in x.dropna().unique() if str(v).strip()]),
-        'exporter': 'first'
-    }).reset_index()
-    trace_agg['certification'] = trace_agg['certification'].replace('', 'Unknown')
-    trace_agg['exporter'] = trace_agg['exporter'].fillna('Unknown')
-
-    # Merge
-    merged_df = farmers_df.merge(trace_agg, on='farmer_id', how='left')
-    merged_df['net_weight_kg'] = merged_df['net_weight_kg'].fillna(0)
+    # farmers.parquet is written last, so its mtime covers both files
+    if farmers_path.exists() and trace_path.exists() and time.time() - os.path.getmtime(farmers_path) < ttl:
+        try:
+            return (pd.read_parquet(farmers_path, engine='pyarrow'),
+                    pd.read_parquet(trace_path, engine='pyarrow'))
+        except Exception:
+            pass  # unreadable cache, refetch below
+
+    merged_df, trace_df = fetch()
+    if not merged_df.empty and not trace_df.empty:
+        try:
+            CACHE_DIR.mkdir(exist_ok=True)
+            trace_df.to_parquet(trace_path, engine='pyarrow', compression='zstd')
+            merged_df.to_parquet(farmers_path, engine='pyarrow', compression='zstd')
+        except Exception:
+            pass  # caching is best effort
+    return merged_df, trace_df
+
+@st.cache_data(ttl=DATA_TTL // 2)
+def load_data(coop=None):
+    """
+    Cached dashboard data; coop=None loads every cooperative. Also returns a
+    data version (the load time) for the per-filter helper caches to key on.
+    """
+    merged_df, trace_df = _load_with_disk_cache(lambda: fetch_data(coop), key=coop)
+
+    # A cooperative without rows yet comes back as a frame without columns
+    if merged_df.empty:
+        merged_df = merged_df.reindex(columns=SUMMARY_COLUMNS)
+    if trace_df.empty:
+        trace_df = trace_df.reindex(columns=TRACE_COLUMNS)
+
+    # Normalise farmer_id once and share one category index between both frames,
+    # so lookups across them compare integer codes instead of strings
+    farmer_ids = merged_df['farmer_id'].astype(str).str.strip().str.lower()
+    trace_ids = trace_df['farmer_id'].astype(str).str.strip().str.lower()
+    cats = pd.Index(pd.concat([farmer_ids, trace_ids]).unique())
+    merged_df['farmer_id'] = pd.Categorical(farmer_ids, categories=cats)
+    trace_df['farmer_id'] = pd.Categorical(trace_ids, categories=cats)
+
+    # Low-cardinality labels as categoricals: less memory, groupby on integer codes
     merged_df['certification'] = merged_df['certification'].fillna('Unknown')
     merged_df['exporter'] = merged_df['exporter'].fillna('Unknown')
+    for col in ['cooperative', 'exporter', 'certification']:
+        merged_df[col] = merged_df[col].astype('category')
+    for col in ['exporter', 'certification']:
+        trace_df[col] = trace_df[col].astype('category')
+
+    # Kilogram columns as float32: half the bytes for every groupby/sum
+    for df in (merged_df, trace_df):
+        for col in ['net_weight_kg', 'max_quota_kg']:
+            if col in df.columns:
+                df[col] = pd.to_numeric(df[col], errors='coerce').astype('float32')
+
+    merged_df['net_weight_kg'] = merged_df['net_weight_kg'].fillna(0)
     merged_df['delivery_percentage'] = (
         merged_df['net_weight_kg'] / merged_df['max_quota_kg'] * 100
     ).round(2).fillna(0)
+    return merged_df, trace_df, time.time()
+
+@st.cache_data(ttl=300)
+def filter_traceability(_trace_df, _filtered_df, coop, exporter, version):
+    """
+    Traceability rows of the filtered farmers, tagged with their cooperative.
+    Cached per (coop, exporter, version); the frames themselves are not hashed.
+    """
+    farmer_coop_map = _filtered_df.drop_duplicates('farmer_id').set_index('farmer_id')['cooperative']
+    filtered_trace = _trace_df[_trace_df['farmer_id'].isin(farmer_coop_map.index)]
+    return filtered_trace.assign(cooperative=filtered_trace['farmer_id'].map(farmer_coop_map))
+
+@st.cache_data(ttl=300)
+def load_cooperatives():
+    """Sorted cooperative names, read from the single farmers.cooperative column."""
+    rows = asyncio.run(fetch_all_pages('farmers', select='cooperative'))
+    return sorted({row['cooperative'] for row in rows if row.get('cooperative')})
+
+# ── Cached aggregations ──────────────────────────────────────────────────────
+# Keyed on the (coop, exporter) selection plus the load_data version; the
+# underscore frames are not hashed, so widget reruns with an unchanged filter
+# skip the pandas work, and a refetch invalidates every entry.
+
+@st.cache_data(ttl=300)
+def delivery_totals(_filtered_df, coop, exporter, version):
+    """
+    Net weight and quota per (cooperative, exporter) in a single groupby pass;
+    the exporter/cooperative summaries and metric totals are derived from it.
+    """
+    # Accumulate in float64: the float32 columns would round large per-group sums
+    weights = _filtered_df[['net_weight_kg', 'max_quota_kg']].astype('float64')
+    return weights.groupby(
+        [_filtered_df['cooperative'], _filtered_df['exporter']], observed=True, dropna=False
+    ).sum()
+
+@st.cache_data(ttl=300)
+def key_metrics(_filtered_df, coop, exporter, version):
+    """(farmer count, total max quota, total delivered) for the metric tiles."""
+    totals = delivery_totals(_filtered_df, coop, exporter, version).sum()  # float64 group sums
+    return (
+        _filtered_df['farmer_id'].nunique(),  # codes of the normalised categorical, no string work
+        float(totals['max_quota_kg']),
+        float(totals['net_weight_kg']),
+    )
+
+@st.cache_data(ttl=300)
+def exporter_summary(_filtered_df, coop, exporter, version):
+    grouped = delivery_totals(_filtered_df, coop, exporter, version)
+    return grouped.groupby(level='exporter', observed=True).sum().reset_index()
+
+@st.cache_data(ttl=300)
+def coop_summary(_filtered_df, coop, exporter, version):
+    grouped = delivery_totals(_filtered_df, coop, exporter, version)
+    return grouped.groupby(level='cooperative', observed=True).sum().reset_index()
+
+@st.cache_data(ttl=300)
+def cert_coop_summary(_trace_df, _filtered_df, coop, exporter, version):
+    filtered_trace = filter_traceability(_trace_df, _filtered_df, coop, exporter, version)
+    return filtered_trace.groupby(['cooperative', 'certification'], observed=True)['net_weight_kg'].sum().reset_index()
+
+@st.cache_data(ttl=300)
+def cert_exp_summary(_trace_df, _filtered_df, coop, exporter, version):
+    filtered_trace = filter_traceability(_trace_df, _filtered_df, coop, exporter, version)
+    return filtered_trace.groupby(['exporter', 'certification'], observed=True)['net_weight_kg'].sum().reset_index()
+
+@st.cache_data(ttl=300)
+def delivery_hist_bins(_filtered_df, coop, exporter, version, nbins=20):
+    """Histogram of delivery_percentage as (bin_start, bin_end, delivery_percentage=midpoint, count)."""
+    values = _filtered_df['delivery_percentage'].to_numpy()
+    counts, edges = np.histogram(values[np.isfinite(values)], bins=nbins)
+    return pd.DataFrame({
+        'bin_start': edges[:-1],
+        'bin_end': edges[1:],
+        'delivery_percentage': (edges[:-1] + edges[1:]) / 2,
+        'count': counts,
+    })
 
-    # ── Restrict data for coop users ─────────────────────────────────────────
-    if current_role != 'admin':
-        merged_df = merged_df[merged_df['cooperative'] == current_coop]
+@st.cache_data(ttl=300)
+def df_to_csv_bytes(_df, df_key):
+    """CSV download payload, serialised once per df_key (a cheap fingerprint of _df)."""
+    return _df.to_csv(index=False).encode('utf-8')
+
+# ── Cached figures ───────────────────────────────────────────────────────────
+# Built from the cached aggregations above, so reruns that don't change the
+# filter also skip Plotly figure construction.
+
+@st.cache_data(ttl=300)
+def build_histogram(_filtered_df, coop, exporter, version):
+    hist_bins = delivery_hist_bins(_filtered_df, coop, exporter, version)
+    fig = px.bar(hist_bins, x='delivery_percentage', y='count',
+                 title='Distribution of Delivery Percentages',
+                 labels={'delivery_percentage': 'Delivery Percentage (%)', 'count': 'Number of Farmers'},
+                 hover_data=['bin_start', 'bin_end'])
+    fig.update_traces(width=(hist_bins['bin_end'] - hist_bins['bin_start']).to_numpy())
+    fig.update_layout(bargap=0)
+    return fig
+
+@st.cache_data(ttl=300)
+def build_status_pie(delivered, non_delivered):
+    fig = go.Figure(data=[go.Pie(
+        labels=['Delivered', 'Not Delivered'],
+        values=[delivered, non_delivered],
+        hole=0.3
+    )])
+    fig.update_layout(title='Farmers by Delivery Status')
+    return fig
+
+@st.cache_data(ttl=300)
+def build_exporter_bar(_filtered_df, coop, exporter, version):
+    return px.bar(exporter_summary(_filtered_df, coop, exporter, version), x='exporter', y='net_weight_kg',
+                  title='Total Net Weight by Exporter',
+                  labels={'net_weight_kg': 'Total Net Weight (kg)', 'exporter': 'Exporter'})
+
+@st.cache_data(ttl=300)
+def build_coop_bar(_filtered_df, coop, exporter, version):
+    return px.bar(coop_summary(_filtered_df, coop, exporter, version), x='cooperative', y='net_weight_kg',
+                  title='Total Net Weight by Cooperative',
+                  labels={'net_weight_kg': 'Total Net Weight (kg)', 'cooperative': 'Cooperative'})
 
+@st.cache_data(ttl=300)
+def build_cert_coop_bar(_trace_df, _filtered_df, coop, exporter, version):
+    return px.bar(cert_coop_summary(_trace_df, _filtered_df, coop, exporter, version),
+                  x='cooperative', y='net_weight_kg', color='certification',
+                  title='Delivery by Cooperative and Certification',
+                  labels={'net_weight_kg': 'Total Net Weight (kg)'})
+
+@st.cache_data(ttl=300)
+def build_cert_exp_bar(_trace_df, _filtered_df, coop, exporter, version):
+    return px.bar(cert_exp_summary(_trace_df, _filtered_df, coop, exporter, version),
+                  x='exporter', y='net_weight_kg', color='certification',
+                  title='Delivery by Exporter and Certification',
+                  labels={'net_weight_kg': 'Total Net Weight (kg)'})
+
+# Non-admin accounts without a cooperative must not fall through to the unfiltered load
+if current_role != 'admin' and not current_coop:
+    st.error("Your account is not linked to a cooperative. Please contact an administrator.")
+    st.stop()
+
+try:
     # ── Sidebar filters ───────────────────────────────────────────────────────
     st.sidebar.header("Filters")
 
     if current_role == 'admin':
-        cooperatives = ['All'] + sorted(merged_df['cooperative'].unique().tolist())
+        cooperatives = ['All'] + load_cooperatives()
         selected_coop = st.sidebar.selectbox("Select Cooperative", cooperatives)
     else:
         selected_coop = current_coop  # coop users are locked to their own coop
 
-    exporters = ['All'] + sorted(merged_df['exporter'].dropna().unique().tolist())
+    # The cooperative filter is applied server-side; coop users only ever load their own rows
+    # Only admins may load every cooperative (coop=None)
+    load_coop = None if current_role == 'admin' and selected_coop == 'All' else selected_coop
+    merged_df, trace_df, data_version = load_data(load_coop)
+
+    # Categories are already the sorted, non-null distinct exporters of the loaded data
+    exporters = ['All'] + merged_df['exporter'].cat.categories.tolist()
     selected_exporter = st.sidebar.selectbox("Select Exporter", exporters)
 
-    # Apply filters
-    filtered_df = merged_df.copy()
-    if current_role == 'admin' and selected_coop != 'All':
-        filtered_df = filtered_df[filtered_df['cooperative'] == selected_coop]
+    # Apply filters (cooperative was already applied by load_data); the frame is only read below
+    filtered_df = merged_df
     if selected_exporter != 'All':
-        filtered_df = filtered_df[filtered_df['exporter'] == selected_exporter]
+        filtered_df = merged_df.loc[(merged_df['exporter'] == selected_exporter).to_numpy()]
 
     # ── Dashboard ─────────────────────────────────────────────────────────────
     st.title("🌾 Farmers Delivery Analytics Dashboard")
 
+    total_farmers, total_quota, total_delivered = key_metrics(
+        filtered_df, selected_coop, selected_exporter, data_version
+    )
+
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        st.metric("Total Farmers", filtered_df['farmer_id'].nunique())
+        st.metric("Total Farmers", total_farmers)
     with col2:
-        st.metric("Total Max Quota (kg)", f"{filtered_df['max_quota_kg'].sum():,.0f}")
+        st.metric("Total Max Quota (kg)", f"{total_quota:,.0f}")
     with col3:
-        st.metric("Total Delivered (kg)", f"{filtered_df['net_weight_kg'].sum():,.0f}")
+        st.metric("Total Delivered (kg)", f"{total_delivered:,.0f}")
     with col4:
-        avg_delivery = (
-            filtered_df['net_weight_kg'].sum() / filtered_df['max_quota_kg'].sum() * 100
-        ) if filtered_df['max_quota_kg'].sum() > 0 else 0
+        avg_delivery = (total_delivered / total_quota * 100) if total_quota > 0 else 0
         st.metric("Overall Delivery %", f"{avg_delivery:.1f}%")
 
     st.divider()
     st.header("📊 Visualizations")
 
+    # One zero-weight mask, shared by the status pie and the non-delivery table
+    weights = filtered_df['net_weight_kg'].to_numpy()
+    mask_zero = weights == 0
+
     chart_col1, chart_col2 = st.columns(2)
     with chart_col1:
         st.subheader("Delivery Percentage Distribution")
-        fig1 = px.histogram(filtered_df, x='delivery_percentage',
-                            title='Distribution of Delivery Percentages',
-                            labels={'delivery_percentage': 'Delivery Percentage (%)', 'count': 'Number of Farmers'},
-                            nbins=20)
+        fig1 = build_histogram(filtered_df, selected_coop, selected_exporter, data_version)
         st.plotly_chart(fig1, use_container_width=True)
 
     with chart_col2:
         st.subheader("Delivery Status")
-        non_delivered = len(filtered_df[filtered_df['net_weight_kg'] == 0])
-        delivered = len(filtered_df[filtered_df['net_weight_kg'] > 0])
-        fig2 = go.Figure(data=[go.Pie(
-            labels=['Delivered', 'Not Delivered'],
-            values=[delivered, non_delivered],
-            hole=0.3
-        )])
-        fig2.update_layout(title='Farmers by Delivery Status')
+        non_delivered = int(np.count_nonzero(mask_zero))
+        delivered = int(np.count_nonzero(weights > 0))
+        fig2 = build_status_pie(delivered, non_delivered)
         st.plotly_chart(fig2, use_container_width=True)
 
     chart_col3, chart_col4 = st.columns(2)
     with chart_col3:
         st.subheader("Total Delivery by Exporter")
-        exporter_summary = filtered_df.groupby('exporter').agg(
-            net_weight_kg=('net_weight_kg', 'sum'),
-            max_quota_kg=('max_quota_kg', 'sum')
-        ).reset_index()
-        fig3 = px.bar(exporter_summary, x='exporter', y='net_weight_kg',
-                      title='Total Net Weight by Exporter',
-                      labels={'net_weight_kg': 'Total Net Weight (kg)', 'exporter': 'Exporter'})
+        fig3 = build_exporter_bar(filtered_df, selected_coop, selected_exporter, data_version)
         st.plotly_chart(fig3, use_container_width=True)
 
     with chart_col4:
         st.subheader("Total Delivery by Cooperative")
-        coop_summary = filtered_df.groupby('cooperative').agg(
-            net_weight_kg=('net_weight_kg', 'sum'),
-            max_quota_kg=('max_quota_kg', 'sum')
-        ).reset_index()
-        fig4 = px.bar(coop_summary, x='cooperative', y='net_weight_kg',
-                      title='Total Net Weight by Cooperative',
-                      labels={'net_weight_kg': 'Total Net Weight (kg)', 'cooperative': 'Cooperative'})
+        fig4 = build_coop_bar(filtered_df, selected_coop, selected_exporter, data_version)
         st.plotly_chart(fig4, use_container_width=True)
 
     st.subheader("Delivery by Certification and Group")
     cert_col1, cert_col2 = st.columns(2)
-    filtered_farmer_ids = filtered_df['farmer_id'].unique()
 
     with cert_col1:
-        cert_coop = trace_df[trace_df['farmer_id'].isin(filtered_farmer_ids)].merge(
-            filtered_df[['farmer_id', 'cooperative']], on='farmer_id', how='left'
-        )
-        cert_coop_summary = cert_coop.groupby(['cooperative', 'certification'])['net_weight_kg'].sum().reset_index()
-        fig5 = px.bar(cert_coop_summary, x='cooperative', y='net_weight_kg', color='certification',
-                      title='Delivery by Cooperative and Certification',
-                      labels={'net_weight_kg': 'Total Net Weight (kg)'})
+        fig5 = build_cert_coop_bar(trace_df, filtered_df, selected_coop, selected_exporter, data_version)
         st.plotly_chart(fig5, use_container_width=True)
 
     with cert_col2:
-        cert_exp = trace_df[trace_df['farmer_id'].isin(filtered_farmer_ids)].copy()
-        cert_exp_summary = cert_exp.groupby(['exporter', 'certification'])['net_weight_kg'].sum().reset_index()
-        fig6 = px.bar(cert_exp_summary, x='exporter', y='net_weight_kg', color='certification',
-                      title='Delivery by Exporter and Certification',
-                      labels={'net_weight_kg': 'Total Net Weight (kg)'})
+        fig6 = build_cert_exp_bar(trace_df, filtered_df, selected_coop, selected_exporter, data_version)
         st.plotly_chart(fig6, use_container_width=True)
 
     st.divider()
     st.header("📋 Detailed Tables")
 
     st.subheader("1. Farmers Delivery Performance")
-    table1_df = filtered_df[['cooperative', 'farmer_id', 'max_quota_kg', 'net_weight_kg', 'delivery_percentage']].copy()
-    table1_df = table1_df.sort_values('delivery_percentage', ascending=False)
+    table1_df = filtered_df[
+        ['cooperative', 'farmer_id', 'max_quota_kg', 'net_weight_kg', 'delivery_percentage']
+    ].sort_values('delivery_percentage', ascending=False)
     st.dataframe(table1_df, use_container_width=True, height=400)
-    st.write(f"**Total Max Quota:** {table1_df['max_quota_kg'].sum():,.2f} kg")
-    st.write(f"**Total Delivered:** {table1_df['net_weight_kg'].sum():,.2f} kg")
+    # float64 sums so the footers match the metric tiles
+    table1_quota = float(table1_df['max_quota_kg'].astype('float64').sum())
+    table1_delivered = float(table1_df['net_weight_kg'].astype('float64').sum())
+    st.write(f"**Total Max Quota:** {table1_quota:,.2f} kg")
+    st.write(f"**Total Delivered:** {table1_delivered:,.2f} kg")
 
     st.divider()
 
     st.subheader("2. Farmers Who Did Not Deliver")
-    non_delivery_df = filtered_df[filtered_df['net_weight_kg'] == 0][
-        ['cooperative', 'farmer_id', 'max_quota_kg', 'net_weight_kg']
-    ].copy()
+    non_delivery_df = filtered_df.loc[
+        mask_zero, ['cooperative', 'farmer_id', 'max_quota_kg', 'net_weight_kg']
+    ]
     st.dataframe(non_delivery_df, use_container_width=True, height=400)
     st.write(f"**Number of Non-Delivering Farmers:** {len(non_delivery_df)}")
-    st.write(f"**Total Undelivered Quota:** {non_delivery_df['max_quota_kg'].sum():,.2f} kg")
+    undelivered_quota = float(non_delivery_df['max_quota_kg'].astype('float64').sum())
+    st.write(f"**Total Undelivered Quota:** {undelivered_quota:,.2f} kg")
 
     st.divider()
     st.header("📥 Download Data")
     dl1, dl2 = st.columns(2)
     with dl1:
+        csv1 = df_to_csv_bytes(table1_df, ('performance', selected_coop, selected_exporter, data_version,
+                                           len(table1_df), table1_quota, table1_delivered))
         st.download_button("Download All Farmers Data",
-                           data=table1_df.to_csv(index=False).encode('utf-8'),
+                           data=csv1,
                            file_name='farmers_delivery_performance.csv',
                            mime='text/csv')
     with dl2:
+        csv2 = df_to_csv_bytes(non_delivery_df, ('non_delivery', selected_coop, selected_exporter, data_version,
+                                                 len(non_delivery_df), undelivered_quota))
         st.download_button("Download Non-Delivery Data",
-                           data=non_delivery_df.to_csv(index=False).encode('utf-8'),
+                           data=csv2,
                            file_name='farmers_non_delivery.csv',
                            mime='text/csv')
 
@@ -0,0 +1,29 @@
+-- Per-farmer delivery summary used by app.py (load_data).
+-- Joins farmers with their aggregated traceability records so the dashboard
+-- can fetch the merged dataset in one call instead of paging both tables.
+-- Requires v_trace_agg.sql to be applied first.
+
+create or replace function public.get_farmer_delivery_summary()
+returns table (
+    farmer_id     text,
+    cooperative   text,
+    max_quota_kg  double precision,
+    net_weight_kg double precision,
+    certification text,
+    exporter      text
+)
+language sql
+stable
+as $$
+    select
+        lower(trim(f.farmer_id::text)),
+        f.cooperative::text,
+        f.max_quota_kg::double precision,
+        coalesce(a.net_weight_kg, 0)::double precision,
+        coalesce(a.certification, 'Unknown'),
+        coalesce(a.exporter::text, 'Unknown')
+    from public.farmers f
+    left join public.v_trace_agg a on a.farmer_id = lower(trim(f.farmer_id::text));
+$$;
+
+grant execute on function public.get_farmer_delivery_summary() to anon, authenticated;
@@ -0,0 +1,19 @@
+-- Per-farmer traceability aggregate: total net weight, distinct non-empty
+-- certifications and the first exporter. Used by get_farmer_delivery_summary()
+-- and read directly by app.py when that function is not deployed.
+
+create index if not exists traceability_farmer_id_norm_idx
+    on public.traceability (lower(trim(farmer_id::text)));
+
+create or replace view public.v_trace_agg
+with (security_invoker = true)
+as
+select
+    lower(trim(t.farmer_id::text)) as farmer_id,
+    sum(t.net_weight_kg)::float4 as net_weight_kg,
+    string_agg(distinct nullif(trim(t.certification::text), ''), ', ') as certification,
+    (array_agg(t.exporter) filter (where t.exporter is not null))[1] as exporter
+from public.traceability t
+group by 1;
+
+grant select on public.v_trace_agg to anon, authenticated;
@@ -0,0 +1,22 @@
+-- Traceability rows tagged with the farmer's cooperative, so app.py can
+-- filter them server-side (?cooperative=eq.<name>) instead of downloading
+-- the whole table for a single cooperative.
+
+create index if not exists farmers_farmer_id_norm_idx
+    on public.farmers (lower(trim(farmer_id::text)));
+create index if not exists farmers_cooperative_idx
+    on public.farmers (cooperative);
+
+create or replace view public.v_traceability
+with (security_invoker = true)
+as
+select t.*, f.cooperative
+from public.traceability t
+left join lateral (
+    select f.cooperative
+    from public.farmers f
+    where lower(trim(f.farmer_id::text)) = lower(trim(t.farmer_id::text))
+    limit 1
+) f on true;
+
+grant select on public.v_traceability to anon, authenticated;